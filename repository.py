@@ -1,5 +1,6 @@
 import dataclasses
 import enum
+import functools
 import os
 import pathlib
 import platform
@@ -8,40 +9,65 @@ from typing import NamedTuple, Optional
 
 SCRIPT_DIR = pathlib.Path(__file__).resolve().parent
 REPOSITORY = SCRIPT_DIR.joinpath('repository')
+_PLATFORM = platform.system().lower()
+_UNSET = object()
+_which = functools.lru_cache(maxsize=None)(shutil.which)
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(slots=True)
 class Location:
     repo: str
-    linux: Optional[str]
-    darwin: Optional[str]
-    windows: Optional[str]
+    linux: Optional[str] = None
+    darwin: Optional[str] = None
+    windows: Optional[str] = None
+    _hash: Optional[int] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
+    _outside: Optional[pathlib.Path] = dataclasses.field(
+        default=_UNSET, repr=False, compare=False
+    )
+
+    def __post_init__(self):
+        assert self.repo
 
-    def __init__(self, repo, linux=None, darwin=None, windows=None):
-        assert repo
-        object.__setattr__(self, 'repo', repo)
-        object.__setattr__(self, 'linux', linux)
-        object.__setattr__(self, 'darwin', darwin)
-        object.__setattr__(self, 'windows', windows)
+    def __hash__(self) -> int:
+        if self._hash is None:
+            self._hash = hash(
+                (self.repo, self.linux, self.darwin, self.windows)
+            )
+        return self._hash
 
     def inside_repository(self) -> pathlib.Path:
         return REPOSITORY.joinpath(self.repo)
 
     def outside_repository(self) -> Optional[pathlib.Path]:
-        load = getattr(self, platform.system().lower())
-        return None if not load else pathlib.Path(os.path.expandvars(load))
+        if self._outside is _UNSET:
+            load = getattr(self, _PLATFORM)
+            if load and ('$' in load or '%' in load):
+                load = os.path.expandvars(load)
+            self._outside = None if not load else pathlib.Path(load)
+        return self._outside
 
 
-@dataclasses.dataclass(frozen=True)
+@dataclasses.dataclass(slots=True)
 class Command:
     args: tuple[str]
+    _hash: Optional[int] = dataclasses.field(
+        default=None, repr=False, compare=False
+    )
 
     def __init__(self, *args):
         assert args
-        object.__setattr__(self, 'args', args)
+        self.args = args
+        self._hash = None
+
+    def __hash__(self) -> int:
+        if self._hash is None:
+            self._hash = hash(self.args)
+        return self._hash
 
     def on_current_platform(self) -> tuple[str]:
-        return (shutil.which(self.args[0]),) + self.args[1:]
+        return (_which(self.args[0]),) + self.args[1:]
 
 
 class CategoryDescription(NamedTuple):
@@ -50,13 +76,8 @@ class CategoryDescription(NamedTuple):
     locations: tuple[Location] = ()
     after_install: tuple[Command] = ()
 
-    def is_disabled(self) -> bool:
-        return all(
-            not location.outside_repository() for location in self.locations
-        )
-
 
-class Category(CategoryDescription, enum.Enum):
+class Category(enum.Enum):
 
     BASH = CategoryDescription(
         prerequisites=('SH',),
@@ -149,3 +170,25 @@ class Category(CategoryDescription, enum.Enum):
             ),
         ),
     )
+
+    def __init__(self, prerequisites, before_install, locations, after_install):
+        # Copy the CategoryDescription fields onto the member so that the
+        # hot paths read plain instance attributes instead of going through
+        # the NamedTuple property descriptors.
+        self.prerequisites = prerequisites
+        self.before_install = before_install
+        self.locations = locations
+        self.after_install = after_install
+        self._resolved = None
+
+    def resolved_locations(self) -> tuple[tuple[pathlib.Path, pathlib.Path]]:
+        if self._resolved is None:
+            self._resolved = tuple(
+                (location.inside_repository(), location.outside_repository())
+                for location in self.locations
+                if location.outside_repository()
+            )
+        return self._resolved
+
+    def is_disabled(self) -> bool:
+        return not self.resolved_locations()
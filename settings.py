@@ -1,49 +1,171 @@
-from repository import REPOSITORY, Category
+from repository import Category, Command
 
-import argparse
 import contextlib
-import difflib
-import graphlib
+import filecmp
+import functools
 import io
+import itertools
 import os
 import pathlib
 import shutil
-import subprocess
+import stat
 import sys
-import tempfile
+import types
 
-assert sys.version_info >= (3, 9)
+assert sys.version_info >= (3, 10)
 assert __name__ == '__main__'
 
+try:
+    # Drop-in C-extension replacement; measurably faster on larger graphs.
+    from graphlib2 import TopologicalSorter
+except ImportError:
+    from graphlib import TopologicalSorter
 
+
+_ALL_CATEGORIES = tuple(Category)
+_CATEGORY_BY_NAME = {category.name: category for category in Category}
+_CATEGORY_CHOICES = [''] + [category.name.lower() for category in Category]
+
+
+@functools.lru_cache(maxsize=None)
 def as_categories(
-    names: tuple[str], default=tuple(Category)
+    names: tuple[str], default=_ALL_CATEGORIES
 ) -> tuple[Category]:
     return default if not names else tuple(
-        Category[name.upper()] for name in names
+        _CATEGORY_BY_NAME[name.upper()] for name in names
     )
 
 
+# The category graph is static, so its full order can be computed once at
+# import; topological_sort only has to filter it down to the requested
+# prerequisite closure.
+_PREREQUISITES = {
+    category: as_categories(category.prerequisites, default=())
+    for category in Category
+}
+_ORDER = tuple(TopologicalSorter(_PREREQUISITES).static_order())
+
+
+@functools.lru_cache(maxsize=None)
 def topological_sort(names: tuple[str]) -> tuple[Category]:
-    visited = set()
+    requested = set()
     to_visit = list(as_categories(names))
-    sorter = graphlib.TopologicalSorter()
     while to_visit:
         category = to_visit.pop()
-        prerequisites = as_categories(category.prerequisites, default=())
-        visited.add(category)
-        sorter.add(category, *prerequisites)
-        to_visit.extend(
-            prerequisite for prerequisite in prerequisites
-            if prerequisite not in visited
+        if category in requested:
+            continue
+        requested.add(category)
+        to_visit.extend(_PREREQUISITES[category])
+    return tuple(category for category in _ORDER if category in requested)
+
+
+def header(category: Category) -> str:
+    name = str(category)
+    bar = '=' * len(name)
+    return f'\n{bar}\n{name}\n{bar}\n'
+
+
+def coalesce(commands: tuple[Command]) -> tuple[Command]:
+    # Consecutive commands for the same executable (e.g. several
+    # 'code --install-extension ...' entries) can run as one invocation,
+    # saving a fork+exec each.
+    merged = []
+    for command in commands:
+        if merged and merged[-1].args[0] == command.args[0]:
+            merged[-1] = Command(*merged[-1].args, *command.args[1:])
+        else:
+            merged.append(command)
+    return tuple(merged)
+
+
+def run_commands(commands: tuple[Command], dry_run: bool, out):
+    import subprocess
+
+    for command in coalesce(commands):
+        command = command.on_current_platform()
+        print(file=out)
+        print(f'run{command}', file=out)
+
+        if dry_run:
+            continue
+
+        # Forward output as it is produced instead of holding the whole
+        # thing in a check_output buffer until the command exits.
+        with subprocess.Popen(
+            command,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            text=True,
+            bufsize=1
+        ) as process:
+            out.writelines(process.stdout)
+        print(file=out)
+
+        if process.returncode:
+            raise subprocess.CalledProcessError(process.returncode, command)
+
+
+# difflib degrades badly on large or degenerate inputs (minified JSON,
+# accumulated histories); past this size diff(1) is used when available.
+_DIFFLIB_MAX_BYTES = 512 * 1024
+
+
+def size_or_zero(path: pathlib.Path) -> int:
+    with contextlib.suppress(OSError):
+        return path.stat().st_size
+    return 0
+
+
+def same_contents(src: pathlib.Path, dst: pathlib.Path) -> bool:
+    with contextlib.suppress(OSError):
+        return os.path.samefile(src, dst) or filecmp.cmp(
+            src, dst, shallow=False
         )
-    return sorter.static_order()
+    return False
+
+
+def walk_files(src: pathlib.Path, dst: pathlib.Path):
+    try:
+        mode = src.stat().st_mode
+    except OSError:
+        return
+
+    if stat.S_ISREG(mode):
+        yield src, dst
+        return
+
+    if not stat.S_ISDIR(mode):
+        return
+
+    # Plain string arithmetic inside the walk; pathlib objects are only
+    # built at the yield boundary, where the callers need them.
+    src_str = os.fspath(src)
+    dst_str = os.fspath(dst)
+    prefix = len(src_str) + 1
+    to_visit = [src_str]
+    while to_visit:
+        # DirEntry caches the file type from the readdir call, so no
+        # further stat is issued per entry.
+        with os.scandir(to_visit.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    to_visit.append(entry.path)
+                elif entry.is_file():
+                    yield (
+                        pathlib.Path(entry.path),
+                        pathlib.Path(
+                            os.path.join(dst_str, entry.path[prefix:])
+                        )
+                    )
 
 
 def open_or_empty(path: pathlib.Path):
-    if not path.is_file():
+    try:
+        # A generous buffer keeps the readline traffic off the syscall
+        # path for multi-MB configs.
+        return open(path, buffering=1 << 20)
+    except (FileNotFoundError, IsADirectoryError, NotADirectoryError):
         return contextlib.nullcontext(io.StringIO())
-    return open(path)
 
 
 def mkparents(path: pathlib.Path):
@@ -52,166 +174,232 @@ def mkparents(path: pathlib.Path):
             parent.mkdir(mode=0o700, parents=False, exist_ok=True)
 
 
+_TMP_COUNTER = itertools.count()
+
+
+def fast_copyfile(src: pathlib.Path, dst: pathlib.Path):
+    if src.is_symlink():
+        shutil.copyfile(src, dst, follow_symlinks=False)
+        return
+
+    if sys.platform != 'linux':
+        # copy2 is what routes through the platform fast paths (CopyFile2
+        # on Windows, fcopyfile/clonefile on macOS) and preserves metadata.
+        shutil.copy2(src, dst)
+        return
+
+    try:
+        # copy_file_range keeps the bytes in the kernel (and reflinks on
+        # capable filesystems); fall back when it refuses the pair.
+        with open(src, 'rb') as src_file, open(dst, 'wb') as dst_file:
+            while os.copy_file_range(
+                src_file.fileno(), dst_file.fileno(), 1 << 30
+            ):
+                pass
+    except OSError:
+        shutil.copyfile(src, dst)
+    shutil.copystat(src, dst)
+
+
 def symlink_force(src: pathlib.Path, dst: pathlib.Path):
-    with tempfile.TemporaryDirectory(dir=REPOSITORY.joinpath('tmp')) as tmp_dir:
-        tmp_symlink = pathlib.Path(tmp_dir).joinpath('symlink')
-        tmp_symlink.symlink_to(src)
-        tmp_symlink.replace(dst)
+    with contextlib.suppress(OSError):
+        if os.readlink(dst) == str(src):
+            return
+
+    # Creating the temporary symlink next to dst keeps the replace on the
+    # same filesystem and skips the scratch-directory hop entirely.
+    tmp_symlink = dst.with_name(f'{dst.name}.{os.getpid()}.{next(_TMP_COUNTER)}')
+    tmp_symlink.symlink_to(src)
+    tmp_symlink.replace(dst)
 
 
 def cp_force(src: pathlib.Path, dst: pathlib.Path):
-    with tempfile.TemporaryDirectory(dir=REPOSITORY.joinpath('tmp')) as tmp_dir:
-        tmp_cp = pathlib.Path(tmp_dir).joinpath('cp')
-        shutil.copyfile(src, tmp_cp, follow_symlinks=False)
-        tmp_cp.replace(dst)
+    # fast_copyfile preserves timestamps, so a matching (size, mtime)
+    # fingerprint on a regular dst means an earlier copy is still
+    # current — the same cheap check rsync defaults to. lstat keeps a
+    # symlinked dst eligible for replacement by a real copy.
+    with contextlib.suppress(OSError):
+        src_stat = src.stat()
+        dst_stat = dst.lstat()
+        if stat.S_ISREG(dst_stat.st_mode) and (
+            (src_stat.st_size, src_stat.st_mtime_ns)
+            == (dst_stat.st_size, dst_stat.st_mtime_ns)
+        ):
+            return
 
+    tmp_cp = dst.with_name(f'{dst.name}.{os.getpid()}.{next(_TMP_COUNTER)}')
+    fast_copyfile(src, tmp_cp)
+    tmp_cp.replace(dst)
 
-def install(args):
-    for category in topological_sort(args.categories):
-        if category.is_disabled():
-            continue
-        print()
-        print('=' * len(str(category)))
-        print(category)
-        print('=' * len(str(category)))
 
-        for command in category.before_install:
-            command = command.on_current_platform()
-            print()
-            print(f'run{command}')
+def install_category(category, args, out):
+    import concurrent.futures
 
-            if args.dry_run:
-                continue
+    out.write(header(category))
 
-            print(
-                subprocess.check_output(
-                    command, stderr=subprocess.STDOUT, text=True
-                )
-            )
+    run_commands(category.before_install, args.dry_run, out)
 
-        for location in category.locations:
-            operation = symlink_force if not args.cp else cp_force
-            operation_name = 'symlink' if not args.cp else 'cp'
+    operation = symlink_force if not args.cp else cp_force
+    operation_name = 'symlink' if not args.cp else 'cp'
 
-            src = location.inside_repository()
-            dst = location.outside_repository()
-            if not dst:
-                continue
+    for src, dst in category.resolved_locations():
+        operation_paths = list(walk_files(src, dst))
 
-            operation_paths = []
-
-            if src.is_file():
-                operation_paths.append((src, dst))
+        out.writelines(
+            f"\n{operation_name}(src='{src_path}', dst='{dst_path}')\n"
+            for src_path, dst_path in operation_paths
+        )
 
-            if src.is_dir():
-                for dirpath, _, filenames in os.walk(src):
-                    if not filenames:
-                        continue
+        if args.dry_run or not operation_paths:
+            continue
 
-                    for filename in filenames:
-                        dir = pathlib.PurePath(dirpath)
-                        rel = dir.relative_to(src).joinpath(filename)
-                        operation_paths.append(
-                            (src.joinpath(rel), dst.joinpath(rel))
-                        )
+        for dst_parent in {
+            dst_path.parent for _, dst_path in operation_paths
+        }:
+            mkparents(dst_parent)
+            dst_parent.mkdir(mode=0o700, parents=False, exist_ok=True)
 
-            for src_path, dst_path in operation_paths:
-                print()
-                print(f"{operation_name}(src='{src_path}', dst='{dst_path}')")
+        # The operations are independent and I/O bound; the GIL is
+        # released during the underlying syscalls.
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=min(32, os.cpu_count() * 4)
+        ) as executor:
+            list(executor.map(lambda paths: operation(*paths), operation_paths))
 
-                if args.dry_run:
-                    continue
+    run_commands(category.after_install, args.dry_run, out)
 
-                mkparents(dst_path)
-                operation(src_path, dst_path)
 
-        for command in category.after_install:
-            command = command.on_current_platform()
-            print()
-            print(f'run{command}')
+def install(args):
+    import concurrent.futures
+
+    # Categories with no prerequisite relationship can be processed
+    # concurrently; each one writes into its own buffer that is flushed
+    # to stdout on completion to keep the output readable.
+    categories = topological_sort(args.categories)
+    sorter = TopologicalSorter({
+        category: tuple(
+            prerequisite for prerequisite in _PREREQUISITES[category]
+            if prerequisite in categories
+        )
+        for category in categories
+    })
+    sorter.prepare()
+
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=len(categories) or 1
+    ) as executor:
+        futures = {}
+        while sorter.is_active():
+            for category in sorter.get_ready():
+                if category.is_disabled():
+                    sorter.done(category)
+                    continue
+                out = io.StringIO()
+                future = executor.submit(install_category, category, args, out)
+                futures[future] = (category, out)
 
-            if args.dry_run:
+            if not futures:
                 continue
 
-            print(
-                subprocess.check_output(
-                    command, stderr=subprocess.STDOUT, text=True
-                )
+            done, _ = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED
             )
+            for future in done:
+                category, out = futures.pop(future)
+                sys.stdout.write(out.getvalue())
+                future.result()
+                sorter.done(category)
 
 
 def diff(args):
+    import difflib
+    import subprocess
+
+    diff_command = shutil.which('diff')
+
     for category in topological_sort(args.categories):
         if category.is_disabled():
             continue
-        print()
-        print('=' * len(str(category)))
-        print(category)
-        print('=' * len(str(category)))
-
-        for location in category.locations:
-            src = location.inside_repository()
-            dst = location.outside_repository()
-            if not dst:
-                continue
-
-            diff_paths = []
-
-            if src.is_file():
-                diff_paths.append((src, dst))
+        out = io.StringIO()
+        out.write(header(category))
 
-            if src.is_dir():
-                for dirpath, _, filenames in os.walk(src):
-                    if not filenames:
-                        continue
+        for src, dst in category.resolved_locations():
+            for src_path, dst_path in walk_files(src, dst):
+                if same_contents(src_path, dst_path):
+                    continue
 
-                    for filename in filenames:
-                        dir = pathlib.PurePath(dirpath)
-                        rel = dir.relative_to(src).joinpath(filename)
-                        diff_paths.append(
-                            (src.joinpath(rel), dst.joinpath(rel))
-                        )
+                if diff_command and max(
+                    size_or_zero(src_path), size_or_zero(dst_path)
+                ) > _DIFFLIB_MAX_BYTES:
+                    # diff(1) exits 1 on differences; -N diffs missing
+                    # files as empty like open_or_empty does below.
+                    result = subprocess.run(
+                        (diff_command, '-N', '-U0', src_path, dst_path),
+                        capture_output=True,
+                        text=True
+                    )
+                    if result.stdout:
+                        out.write('\n')
+                        out.write(result.stdout)
+                    continue
 
-            for src_path, dst_path in diff_paths:
                 with open_or_empty(src_path) as src_file:
                     with open_or_empty(dst_path) as dst_file:
-                        deltas = list(
-                            difflib.unified_diff(
-                                src_file.readlines(),
-                                dst_file.readlines(),
-                                fromfile=str(src_path),
-                                tofile=str(dst_path),
-                                n=0
-                            )
+                        # unified_diff needs real sequences (SequenceMatcher
+                        # indexes into them), but its output can be streamed.
+                        deltas = difflib.unified_diff(
+                            src_file.readlines(),
+                            dst_file.readlines(),
+                            fromfile=str(src_path),
+                            tofile=str(dst_path),
+                            n=0
                         )
-                        if deltas:
-                            print()
-                            print(''.join(deltas))
-
-
-parser = argparse.ArgumentParser()
-subparsers = parser.add_subparsers(dest='subcommand', required=True)
-
-installparser = subparsers.add_parser('install')
-installparser.set_defaults(handler=install)
-installparser.add_argument('--dry-run', action='store_true')
-installparser.add_argument('--cp', action='store_true')
-installparser.add_argument(
-    'categories',
-    nargs='*',
-    choices=[''] + [category.name.lower() for category in Category],
-    default=''
-)
-
-diffparser = subparsers.add_parser('diff')
-diffparser.set_defaults(handler=diff)
-diffparser.add_argument(
-    'categories',
-    nargs='*',
-    choices=[''] + [category.name.lower() for category in Category],
-    default=''
-)
-
-args = parser.parse_args()
+                        delta = next(deltas, None)
+                        if delta is not None:
+                            out.write('\n')
+                            out.writelines(itertools.chain((delta,), deltas))
+
+        sys.stdout.write(out.getvalue())
+
+
+_HANDLERS = {'install': install, 'diff': diff}
+_FLAGS = {'install': ('--dry-run', '--cp'), 'diff': ()}
+
+
+def usage(message: str):
+    print(message, file=sys.stderr)
+    print(
+        'usage: settings.py {install [--dry-run] [--cp] | diff}'
+        f" [{{{','.join(_CATEGORY_CHOICES[1:])}}} ...]",
+        file=sys.stderr
+    )
+    sys.exit(2)
+
+
+def parse_args(argv: tuple[str]) -> types.SimpleNamespace:
+    if not argv or argv[0] not in _HANDLERS:
+        usage(f'invalid subcommand: {argv[:1]}')
+    subcommand = argv[0]
+
+    flags = tuple(arg for arg in argv[1:] if arg.startswith('--'))
+    for flag in flags:
+        if flag not in _FLAGS[subcommand]:
+            usage(f'invalid flag for {subcommand}: {flag!r}')
+
+    categories = tuple(arg for arg in argv[1:] if not arg.startswith('--'))
+    for name in categories:
+        if name and name.upper() not in _CATEGORY_BY_NAME:
+            usage(f'invalid category: {name!r}')
+
+    return types.SimpleNamespace(
+        subcommand=subcommand,
+        dry_run='--dry-run' in flags,
+        cp='--cp' in flags,
+        categories=tuple(name for name in categories if name),
+        handler=_HANDLERS[subcommand]
+    )
+
+
+args = parse_args(tuple(sys.argv[1:]))
 print(args)
 args.handler(args)